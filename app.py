@@ -1,114 +1,506 @@
 import streamlit as st
 from docx import Document
-from openai import OpenAI
+from docx.enum.text import WD_COLOR_INDEX
+from docx.oxml.ns import qn
+from lxml import etree
+from openai import AsyncOpenAI, OpenAI, RateLimitError
 from io import BytesIO
+import asyncio
+import gc
+import json
 import re
 import os
+import time
+import zipfile
 
 # --- CONFIGURATION ---
 # IMPORTANT: Make sure this file exists in the same folder as app.py
 TEMPLATE_FILENAME = "Template.docx"
 
+# Max in-flight OpenAI requests. Keeps the concurrent speedup while
+# staying under RPM/TPM limits so we don't trigger 429 retry storms.
+MAX_CONCURRENT_REQUESTS = 16
+
+# Steps analyzed per request. Batching amortizes the round-trip and the
+# shared system prompt; ~20 keeps the reply well under output token limits.
+BATCH_CHUNK_SIZE = 20
+
+# Above this step count, offer the OpenAI Batch API: ~50% token cost and
+# no rate-limit grinding, at the price of minutes-scale turnaround.
+BATCH_API_THRESHOLD = 100
+BATCH_POLL_SECONDS = 30
+
 # --- PAGE CONFIG ---
 st.set_page_config(page_title="JHA Generator", page_icon="🦺", layout="centered")
 
 # --- HELPER FUNCTIONS ---
 
+# Compiled once at import; these run for every step on every generation.
+_CLEAN_RE = re.compile(r'^(output|response|answer|step \d+|analysis)[:\s-]*', re.IGNORECASE)
+_HDR_RE = re.compile(r'DESCRIPTION.*OPERATION', re.IGNORECASE | re.DOTALL)
+
 def clean_response(text):
     """
     Aggressively cleans AI output to ensure consistency.
     Removes 'Output:', 'Response:', quotes, and extra whitespace.
     """
-    text = re.sub(r'^(output|response|answer|step \d+|analysis)[:\s-]*', '', text, flags=re.IGNORECASE)
+    text = _CLEAN_RE.sub('', text)
     text = text.replace('"', '').replace("'", "")
     return text.strip()
 
-def get_ai_safety_analysis(client, step_text):
+SYSTEM_MSG = "You are a strict data extraction engine for construction safety. You do not chat."
+
+async def ai_chat_completion(client, semaphore, user_msg, **kwargs):
+    """
+    Chat completion with bounded concurrency and exponential backoff
+    (1s, 2s, 4s) on rate limits before giving up.
+    """
+    async with semaphore:
+        for delay in (1, 2, 4, None):
+            try:
+                return await client.chat.completions.create(
+                    messages=[
+                        {"role": "system", "content": SYSTEM_MSG},
+                        {"role": "user", "content": user_msg}
+                    ],
+                    temperature=0.0, # Zero creativity = Maximum Consistency
+                    seed=42,         # Mathematical Determinism
+                    **kwargs
+                )
+            except RateLimitError:
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+def build_step_prompt(step_text):
+    """Single-step user prompt, shared by real-time and Batch API paths."""
+    return (
+        f"Analyze this specific MOP step: '{step_text}'\n\n"
+        "INSTRUCTIONS:\n"
+        "1. DECIDE: Is this step 'Administrative/Safe' OR 'Physical/Hazardous'?\n"
+        "   - Safe: Software, checking notes, phone calls, meetings, verifying, notifying.\n"
+        "   - Hazardous: Using tools, LOTO, electrical work, ladders, chemicals, pressure.\n"
+        "2. OUTPUT FORMAT: Return strictly 'Hazard | Control' (separated by a pipe).\n"
+        "3. FOR SAFE STEPS: You MUST return exactly: N/A | N/A\n\n"
+        "EXAMPLES:\n"
+        "Input: 'Contact the client.' -> Output: N/A | N/A\n"
+        "Input: 'Disconnect the main breaker.' -> Output: Electrical Shock | LOTO & Verify Zero Energy\n"
+        "Input: 'Update the software tags.' -> Output: N/A | N/A\n"
+        "Input: 'Climb ladder to inspect unit.' -> Output: Fall Hazard | Secure Ladder & 3-Points Contact\n\n"
+        "Your Output:"
+    )
+
+def parse_step_reply(content):
+    """Turns a raw 'Hazard | Control' reply into a (hazard, control) pair."""
+    cleaned_content = clean_response(content.strip())
+    if "|" in cleaned_content:
+        parts = cleaned_content.split("|")
+        return parts[0].strip(), parts[1].strip()
+    return "N/A", "N/A"
+
+async def get_ai_safety_analysis(client, semaphore, model, step_text):
     """
-    Sends step to OpenAI with STRICT instructions for consistency.
+    Sends a single step to OpenAI with STRICT instructions for consistency.
+    Fallback path when a batched response can't be parsed.
     """
     try:
-        system_msg = "You are a strict data extraction engine for construction safety. You do not chat."
-        
-        user_msg = (
-            f"Analyze this specific MOP step: '{step_text}'\n\n"
-            "INSTRUCTIONS:\n"
-            "1. DECIDE: Is this step 'Administrative/Safe' OR 'Physical/Hazardous'?\n"
-            "   - Safe: Software, checking notes, phone calls, meetings, verifying, notifying.\n"
-            "   - Hazardous: Using tools, LOTO, electrical work, ladders, chemicals, pressure.\n"
-            "2. OUTPUT FORMAT: Return strictly 'Hazard | Control' (separated by a pipe).\n"
-            "3. FOR SAFE STEPS: You MUST return exactly: N/A | N/A\n\n"
-            "EXAMPLES:\n"
-            "Input: 'Contact the client.' -> Output: N/A | N/A\n"
-            "Input: 'Disconnect the main breaker.' -> Output: Electrical Shock | LOTO & Verify Zero Energy\n"
-            "Input: 'Update the software tags.' -> Output: N/A | N/A\n"
-            "Input: 'Climb ladder to inspect unit.' -> Output: Fall Hazard | Secure Ladder & 3-Points Contact\n\n"
-            "Your Output:"
-        )
-        
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": user_msg}
-            ],
-            temperature=0.0, # Zero creativity = Maximum Consistency
-            seed=42          # Mathematical Determinism
+        # Output is ~15 tokens ("Hazard | Control"); a tight cap trims
+        # tail latency and kills any runaway generation.
+        response = await ai_chat_completion(
+            client, semaphore, build_step_prompt(step_text),
+            model=model,
+            max_tokens=40,
+            stop=["\n\n"]
         )
-        
-        raw_content = response.choices[0].message.content.strip()
-        cleaned_content = clean_response(raw_content)
-        
-        if "|" in cleaned_content:
-            parts = cleaned_content.split("|")
-            return parts[0].strip(), parts[1].strip()
-        return "N/A", "N/A"
-        
+
+        return parse_step_reply(response.choices[0].message.content)
+
     except Exception as e:
         st.error(f"AI Error: {e}")
         return "Manual Review Required", "Manual Review Required"
 
-def extract_rich_text(cell):
-    """Extracts text segments with their original bold/highlight formatting."""
+async def get_ai_batch_analysis(client, semaphore, model, step_texts):
+    """
+    Analyzes a whole chunk of steps in ONE request. The shared system
+    prompt and round-trip are paid once instead of once per step.
+    Falls back to per-step calls if the JSON can't be parsed.
+    """
+    user_msg = (
+        "Analyze the following JSON array of MOP steps.\n\n"
+        "INSTRUCTIONS:\n"
+        "1. For EACH step, DECIDE: Is it 'Administrative/Safe' OR 'Physical/Hazardous'?\n"
+        "   - Safe: Software, checking notes, phone calls, meetings, verifying, notifying.\n"
+        "   - Hazardous: Using tools, LOTO, electrical work, ladders, chemicals, pressure.\n"
+        "2. OUTPUT FORMAT: Return a JSON object {\"results\": [...]} with EXACTLY one entry\n"
+        "   per step, in the same order, each shaped {\"hazard\": \"...\", \"control\": \"...\"}.\n"
+        "3. FOR SAFE STEPS: hazard and control MUST both be exactly \"N/A\"\n\n"
+        "EXAMPLES:\n"
+        "'Contact the client.' -> {\"hazard\": \"N/A\", \"control\": \"N/A\"}\n"
+        "'Disconnect the main breaker.' -> {\"hazard\": \"Electrical Shock\", \"control\": \"LOTO & Verify Zero Energy\"}\n"
+        "'Climb ladder to inspect unit.' -> {\"hazard\": \"Fall Hazard\", \"control\": \"Secure Ladder & 3-Points Contact\"}\n\n"
+        f"STEPS:\n{json.dumps(step_texts)}"
+    )
+
+    try:
+        response = await ai_chat_completion(
+            client, semaphore, user_msg,
+            model=model,
+            response_format={"type": "json_object"},
+            # ~25 tokens per {hazard, control} entry; budget generously
+            # per step but never allow a runaway reply.
+            max_tokens=60 * len(step_texts) + 20
+        )
+
+        results = json.loads(response.choices[0].message.content)["results"]
+        if len(results) != len(step_texts):
+            raise ValueError("Result count does not match step count")
+
+        return [
+            (clean_response(str(item.get("hazard", "N/A"))),
+             clean_response(str(item.get("control", "N/A"))))
+            for item in results
+        ]
+
+    except Exception:
+        # Malformed batch reply: retry the chunk one step at a time
+        singles = [get_ai_safety_analysis(client, semaphore, model, t) for t in step_texts]
+        return await asyncio.gather(*singles)
+
+def normalize_step(text):
+    """Cache key for a step: lowercased, whitespace-collapsed text."""
+    return re.sub(r'\s+', ' ', text.lower().strip())
+
+# Obviously administrative phrasing -> N/A with no API call.
+SAFE_RE = re.compile(
+    r'\b(contact|notify|update|verify notes|email|call|meeting|document|record|log|review)\b',
+    re.IGNORECASE)
+# Anything that smells like physical work must still go to the model.
+HAZARD_RE = re.compile(
+    r'\b(loto|lock\s?out|tag\s?out|ladder|breaker|energi[sz]e|voltage|electrical'
+    r'|chemical|crane|torque|pressure|valve|hoist|drill|weld|scaffold)\b',
+    re.IGNORECASE)
+
+def prefilter_step(text):
+    """
+    Classifies obviously administrative steps locally so they never hit
+    the API. Conservative: only short-circuits when the text matches a
+    safe keyword AND nothing hazardous appears; everything ambiguous
+    still goes to the model.
+    """
+    if SAFE_RE.search(text) and not HAZARD_RE.search(text):
+        return "N/A", "N/A"
+    return None
+
+def run_safety_analysis(api_key, model, step_texts, progress_callback=None):
+    """
+    Analyzes all steps by batching them into chunks and running the
+    chunk requests concurrently, so wall time is roughly one call's
+    latency regardless of step count. progress_callback (0.0-1.0) is
+    ticked as each chunk finishes, not after the whole gather, so the
+    user sees movement while calls are still in flight.
+
+    Results are cached in session_state by (model, normalized text),
+    so regenerating skips the API entirely for anything already
+    analyzed this session, and duplicate steps within one MOP are
+    dispatched only once and fanned back to every occurrence.
+    """
+    cache = st.session_state.setdefault('jha_cache', {})
+    results = [prefilter_step(t) or cache.get((model, normalize_step(t)))
+               for t in step_texts]
+    pending_idx = [i for i, r in enumerate(results) if r is None]
+
+    if pending_idx:
+        # Dedupe within the run: one call per unique normalized step,
+        # fanned back to every occurrence afterwards
+        buckets = {}
+        for i in pending_idx:
+            buckets.setdefault(normalize_step(step_texts[i]), []).append(i)
+        unique_texts = [step_texts[idxs[0]] for idxs in buckets.values()]
+
+        async def _run():
+            client = AsyncOpenAI(api_key=api_key)
+            semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+            chunks = [unique_texts[i:i + BATCH_CHUNK_SIZE]
+                      for i in range(0, len(unique_texts), BATCH_CHUNK_SIZE)]
+
+            async def analyze_chunk(chunk_idx, chunk):
+                return chunk_idx, await get_ai_batch_analysis(client, semaphore, model, chunk)
+
+            chunk_results = [None] * len(chunks)
+            done_steps = 0
+            for future in asyncio.as_completed(
+                    [analyze_chunk(idx, chunk) for idx, chunk in enumerate(chunks)]):
+                idx, pairs = await future
+                chunk_results[idx] = pairs
+                done_steps += len(pairs)
+                if progress_callback:
+                    progress_callback(done_steps / len(unique_texts))
+            return [pair for chunk in chunk_results for pair in chunk]
+
+        for (key, idxs), pair in zip(buckets.items(), asyncio.run(_run())):
+            for i in idxs:
+                results[i] = pair
+            if pair[0] != "Manual Review Required":  # Don't cache failures
+                cache[(model, key)] = pair
+
+    return results
+
+def run_batch_safety_analysis(api_key, model, step_texts, status):
+    """
+    Analyzes steps through the OpenAI Batch API: one JSONL request per
+    step, ~50% token cost, no rate-limit grinding — at the price of
+    minutes-scale turnaround. Worth it for very large MOPs where even
+    concurrent real-time calls would queue behind RPM limits.
+    """
+    client = OpenAI(api_key=api_key)
+
+    lines = "\n".join(json.dumps({
+        "custom_id": str(i),
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model,
+            "messages": [
+                {"role": "system", "content": SYSTEM_MSG},
+                {"role": "user", "content": build_step_prompt(text)}
+            ],
+            "temperature": 0.0,
+            "seed": 42,
+            "max_tokens": 40
+        }
+    }) for i, text in enumerate(step_texts))
+
+    batch_file = client.files.create(
+        file=BytesIO(lines.encode("utf-8")), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h")
+    status.write(f"Batch {batch.id} submitted ({len(step_texts)} steps). Polling...")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(BATCH_POLL_SECONDS)
+        batch = client.batches.retrieve(batch.id)
+
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"Batch ended with status '{batch.status}'")
+
+    # Anything the batch didn't answer stays flagged for manual review
+    results = [("Manual Review Required", "Manual Review Required")] * len(step_texts)
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        item = json.loads(line)
+        try:
+            content = item["response"]["body"]["choices"][0]["message"]["content"]
+        except (KeyError, TypeError):
+            continue
+        results[int(item["custom_id"])] = parse_step_reply(content)
+
+    return results
+
+def _tc_text(tc):
+    """
+    Plain text of a <w:tc> element, no python-docx wrappers needed.
+    Reads <w:t> nodes only, so field codes and tracked deletions don't
+    leak into the scan the way itertext() would let them.
+    """
+    return "".join(t.text or "" for t in tc.iter(qn('w:t')))
+
+def extract_rich_text(tc):
+    """
+    Extracts text segments with their original bold/highlight formatting
+    straight from a <w:tc> element.
+    """
     segments = []
     plain_text_parts = []
-    
-    for p in cell.paragraphs:
-        for run in p.runs:
-            text = run.text
+
+    for p in tc.findall(qn('w:p')):
+        for r in p.findall(qn('w:r')):
+            text_parts = []
+            for child in r:
+                if child.tag == qn('w:t'):
+                    text_parts.append(child.text or "")
+                elif child.tag == qn('w:tab'):
+                    text_parts.append("\t")
+                elif child.tag in (qn('w:br'), qn('w:cr')):
+                    text_parts.append("\n")
+            text = "".join(text_parts)
             if not text: continue
+
+            bold = False
+            highlight = None
+            rPr = r.find(qn('w:rPr'))
+            if rPr is not None:
+                b = rPr.find(qn('w:b'))
+                bold = b is not None and b.get(qn('w:val')) not in ('0', 'false')
+                h = rPr.find(qn('w:highlight'))
+                if h is not None:
+                    try:
+                        highlight = WD_COLOR_INDEX.from_xml(h.get(qn('w:val')))
+                    except (KeyError, ValueError):
+                        highlight = None
+
             plain_text_parts.append(text)
             segments.append({
                 "text": text,
-                "bold": run.bold,
-                "highlight": run.font.highlight_color
+                "bold": bold,
+                "highlight": highlight
             })
-    
+
     return {
         "plain": "".join(plain_text_parts).strip(),
         "segments": segments
     }
 
-def apply_template_font(target_run, template_cell):
-    """Clones the base font name and size from the template."""
-    if template_cell.paragraphs and template_cell.paragraphs[0].runs:
-        tmpl_run = template_cell.paragraphs[0].runs[0]
-        target_run.font.name = tmpl_run.font.name
-        if tmpl_run.font.size:
-            target_run.font.size = tmpl_run.font.size
+@st.cache_data(show_spinner=False)
+def load_template_bytes():
+    """
+    Template bytes, read from disk once per session. Each run builds a
+    fresh Document from them, so the cached copy is never mutated.
+    """
+    with open(TEMPLATE_FILENAME, "rb") as f:
+        return f.read()
+
+@st.cache_data(show_spinner=False)
+def parse_mop(file_bytes):
+    """
+    Finds the 'DESCRIPTION OF WORK OPERATION' column and extracts its
+    steps by iterating word/document.xml one <w:tbl> at a time. We only
+    need that single column, so skipping the full python-docx parse
+    keeps memory flat for large MOPs (each table is freed as soon as
+    it's been scanned). Cached on the raw file bytes, so regenerating
+    the same MOP skips the parse entirely.
+
+    Returns (steps_data, table_idx); table_idx is None if no header
+    was found.
+    """
+    with zipfile.ZipFile(BytesIO(file_bytes)) as zf:
+        document_xml = zf.read('word/document.xml')
+
+    steps_data = []
+    found_table = None
+    tbl_tag = qn('w:tbl')
+    t_idx = -1
+
+    # Deep Scan for Header
+    for _, tbl in etree.iterparse(BytesIO(document_xml), events=('end',), tag=tbl_tag):
+        # Nested tables are scanned as part of their parent
+        if any(anc.tag == tbl_tag for anc in tbl.iterancestors()):
+            continue
+        t_idx += 1
+
+        rows = tbl.findall(qn('w:tr'))
+        target_col = -1
+        header_row = -1
+
+        # Search rows 0-6
+        for r_idx, tr in enumerate(rows[:6]):
+            cells = tr.findall(qn('w:tc'))
+            for c_idx, tc in enumerate(cells):
+                if _HDR_RE.search(_tc_text(tc)):
+                    target_col = c_idx
+                    header_row = r_idx
+                    found_table = t_idx
+                    break
+            if target_col != -1: break
+
+        if target_col != -1:
+            for tr in rows[header_row + 1:]:
+                cells = tr.findall(qn('w:tc'))
+                if len(cells) > target_col:
+                    tc = cells[target_col]
+                    txt_check = _tc_text(tc).strip()
+                    # Filter garbage
+                    if (len(txt_check) > 3
+                        and "DESCRIPTION" not in txt_check.upper()
+                        and "DO NOT DELETE" not in txt_check.upper()
+                        and "JE DUNN" not in txt_check.upper()):
+
+                        steps_data.append(extract_rich_text(tc))
+            tbl.clear()
+            break
+
+        # Done scanning this table; drop its subtree so memory stays flat
+        tbl.clear()
+
+    return steps_data, found_table
+
+def append_step_paragraph(tc, step_index, segments, template_font):
+    """
+    Writes the 'Step N:' prefix plus all rich-text segments into a cell
+    as ONE assembled <w:p> element. python-docx's add_run performs an
+    lxml mutation per run; building the paragraph directly turns N·S
+    mutations into a single append per step.
+    """
+    p = etree.SubElement(tc, qn('w:p'))
+
+    def add_run(text, bold=False, highlight=None):
+        r = etree.SubElement(p, qn('w:r'))
+        rPr = etree.SubElement(r, qn('w:rPr'))
+        # Children must follow the CT_RPr schema order:
+        # rFonts, b, sz, highlight
+        if template_font and template_font[0]:
+            rFonts = etree.SubElement(rPr, qn('w:rFonts'))
+            rFonts.set(qn('w:ascii'), template_font[0])
+            rFonts.set(qn('w:hAnsi'), template_font[0])
+        if bold:
+            etree.SubElement(rPr, qn('w:b'))
+        if template_font and template_font[1]:
+            sz = etree.SubElement(rPr, qn('w:sz'))
+            sz.set(qn('w:val'), str(int(template_font[1].pt * 2)))
+        if highlight is not None:
+            hl = etree.SubElement(rPr, qn('w:highlight'))
+            hl.set(qn('w:val'), WD_COLOR_INDEX.to_xml(highlight))
+        if len(rPr) == 0:
+            r.remove(rPr)
+        t = etree.SubElement(r, qn('w:t'))
+        t.set(qn('xml:space'), 'preserve')
+        t.text = text
+
+    add_run(f"Step {step_index}:", bold=True)
+    br_run = etree.SubElement(p, qn('w:r'))
+    etree.SubElement(br_run, qn('w:br'))
+
+    for seg in segments:
+        add_run(seg['text'], bold=seg['bold'], highlight=seg['highlight'])
+
+def get_template_font(style_ref_cell):
+    """
+    Reads the template's base (name, size) once so the write loop
+    doesn't re-traverse the reference cell for every run it creates.
+    """
+    if style_ref_cell and style_ref_cell.paragraphs and style_ref_cell.paragraphs[0].runs:
+        ref_run = style_ref_cell.paragraphs[0].runs[0]
+        return (ref_run.font.name, ref_run.font.size)
+    return None
+
+def apply_template_font(target_run, template_font):
+    """Applies a cached (name, size) pair from get_template_font."""
+    if template_font:
+        target_run.font.name = template_font[0]
+        if template_font[1]:
+            target_run.font.size = template_font[1]
 
 # --- MAIN APP LOGIC ---
 
 st.title("🦺 MOP to JHA Converter")
 st.markdown("Upload your MOP to generate a safety document using the standard template.")
 
-# 1. API KEY HANDLING
+# 1. API KEY & MODEL HANDLING
+with st.sidebar:
+    st.header("Settings")
+    # mini is ~10x cheaper/faster and just as reliable for this
+    # short classification task; 4o stays available as an override.
+    model_choice = st.selectbox("Model", ["gpt-4o-mini", "gpt-4o"])
+    batch_mode = st.checkbox(f"Batch API for MOPs over {BATCH_API_THRESHOLD} steps")
+    st.caption("Batch runs cost ~50% less but can take several minutes.")
+
 api_key = None
 if "OPENAI_API_KEY" in st.secrets:
     api_key = st.secrets["OPENAI_API_KEY"]
 else:
     with st.sidebar:
-        st.header("Settings")
         api_key = st.text_input("OpenAI API Key", type="password")
         st.caption("Key is not stored. Used for this session only.")
 
@@ -130,51 +522,19 @@ if st.button("Generate JHA", type="primary"):
         st.error("Please upload the MOP file.")
         st.stop()
 
-    # Initialize OpenAI
-    client = OpenAI(api_key=api_key)
-
-    # Load Documents
+    # Load Documents (template bytes are cached; the parse below is too)
     try:
-        mop_doc = Document(mop_file)
-        # Load Template from local path
-        jha_doc = Document(TEMPLATE_FILENAME)
+        mop_bytes = mop_file.getvalue()
+        jha_doc = Document(BytesIO(load_template_bytes()))
     except Exception as e:
         st.error(f"Error reading files: {e}")
         st.stop()
 
     # --- STEP A: EXTRACT STEPS FROM MOP ---
     status = st.status("Scanning MOP...", expanded=True)
-    steps_data = []
-    
-    # Deep Scan for Header
-    for t_idx, table in enumerate(mop_doc.tables):
-        target_col = -1
-        header_row = -1
-        
-        # Search rows 0-6
-        for r_idx, row in enumerate(table.rows[:6]):
-            for c_idx, cell in enumerate(row.cells):
-                clean_txt = cell.text.strip().upper()
-                if "DESCRIPTION" in clean_txt and "OPERATION" in clean_txt:
-                    target_col = c_idx
-                    header_row = r_idx
-                    status.write(f"Found Header in Table {t_idx+1}")
-                    break
-            if target_col != -1: break
-            
-        if target_col != -1:
-            for row in table.rows[header_row + 1:]:
-                if len(row.cells) > target_col:
-                    cell = row.cells[target_col]
-                    txt_check = cell.text.strip()
-                    # Filter garbage
-                    if (len(txt_check) > 3 
-                        and "DESCRIPTION" not in txt_check.upper() 
-                        and "DO NOT DELETE" not in txt_check.upper()
-                        and "JE DUNN" not in txt_check.upper()):
-                        
-                        steps_data.append(extract_rich_text(cell))
-            break 
+    steps_data, found_table = parse_mop(mop_bytes)
+    if found_table is not None:
+        status.write(f"Found Header in Table {found_table+1}")
 
     if not steps_data:
         status.update(label="Error: No steps found!", state="error")
@@ -186,7 +546,11 @@ if st.button("Generate JHA", type="primary"):
     # --- STEP B: PREPARE JHA TEMPLATE ---
     target_table = None
     for table in jha_doc.tables:
-        if table.rows and "Sequence" in table.rows[0].cells[0].text:
+        # Check the first cell's w:t nodes directly; .rows/.cells/.text
+        # would build a wrapper object per access just to read a string
+        first_tr = table._element.find(qn('w:tr'))
+        first_tc = first_tr.find(qn('w:tc')) if first_tr is not None else None
+        if first_tc is not None and "Sequence" in _tc_text(first_tc):
             target_table = table
             break
             
@@ -196,63 +560,76 @@ if st.button("Generate JHA", type="primary"):
         st.stop()
 
     style_ref_cell = target_table.rows[1].cells[0] if len(target_table.rows) > 1 else None
+    template_font = get_template_font(style_ref_cell)
 
-    # Clear old rows
-    for i in range(len(target_table.rows) - 1, 0, -1):
-        target_table._element.remove(target_table.rows[i]._element)
+    # Clear old rows (keep the header). Work on the tbl element directly;
+    # re-reading target_table.rows every iteration walks the XML each time.
+    tbl = target_table._element
+    for tr in tbl.findall(qn('w:tr'))[1:]:
+        tbl.remove(tr)
 
-    # --- STEP C: AI ANALYSIS LOOP ---
+    # --- STEP C: AI ANALYSIS (CONCURRENT) ---
     status.write("Running AI Safety Analysis...")
     progress_bar = st.progress(0)
-    
+
+    step_texts = [s['plain'] for s in steps_data]
+    if batch_mode and len(step_texts) > BATCH_API_THRESHOLD:
+        # Hundreds of steps: hand the whole job to the Batch API
+        try:
+            results = run_batch_safety_analysis(api_key, model_choice, step_texts, status)
+        except Exception as e:
+            status.update(label="Batch failed!", state="error")
+            st.error(f"Batch API Error: {e}")
+            st.stop()
+    else:
+        # Fire all step analyses at once instead of one blocking call per step
+        results = run_safety_analysis(api_key, model_choice, step_texts,
+                                      progress_callback=progress_bar.progress)
+    progress_bar.progress(1.0)
+
     for i, step_obj in enumerate(steps_data):
-        # Update Progress
-        progress_bar.progress((i + 1) / len(steps_data))
-        
-        # 1. AI Analysis
-        haz, ctrl = get_ai_safety_analysis(client, step_obj['plain'])
-        
-        # 2. Add Row
+        haz, ctrl = results[i]
+
+        # Add Row
         new_row = target_table.add_row()
         
-        # Col 1: Step X + Rich Text
+        # Col 1: Step X + Rich Text, assembled as one paragraph element
         cell_step = new_row.cells[0]
         cell_step._element.clear_content()
-        p = cell_step.add_paragraph()
-        
-        run_prefix = p.add_run(f"Step {i}:") # Starts at 0
-        run_prefix.bold = True
-        if style_ref_cell: apply_template_font(run_prefix, style_ref_cell)
-        p.add_run("\n")
-        
-        for seg in step_obj['segments']:
-            r = p.add_run(seg['text'])
-            if seg['bold']: r.bold = True
-            if seg['highlight']: r.font.highlight_color = seg['highlight']
-            if style_ref_cell: apply_template_font(r, style_ref_cell)
+        append_step_paragraph(cell_step._element, i, step_obj['segments'], template_font)  # Starts at 0
 
         # Col 2 & 3: Hazards/Controls
         new_row.cells[1].text = haz
         new_row.cells[2].text = ctrl
         
-        if style_ref_cell:
+        if template_font:
             for col_idx in [1, 2]:
                 cell = new_row.cells[col_idx]
                 if cell.paragraphs:
                     for run in cell.paragraphs[0].runs:
-                        apply_template_font(run, style_ref_cell)
+                        apply_template_font(run, template_font)
 
     status.update(label="Complete!", state="complete")
     
     # --- STEP D: DOWNLOAD ---
-    buffer = BytesIO()
-    jha_doc.save(buffer)
+    # Reuse one output buffer for the whole session; truncating in
+    # place avoids reallocating (and briefly doubling) the document
+    # bytes every time the user regenerates.
+    buffer = st.session_state.setdefault('jha_buf', BytesIO())
+    buffer.truncate(0)
     buffer.seek(0)
-    
+    jha_doc.save(buffer)
+
     st.success("Analysis Complete!")
     st.download_button(
         label="📥 Download Final JHA",
-        data=buffer,
+        data=buffer.getvalue(),
         file_name="Final_JHA.docx",
         mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-    )
\ No newline at end of file
+    )
+
+    # python-docx/lxml hold large object graphs that linger after scope
+    # exit; drop them and collect so the worker's RSS doesn't grow with
+    # every upload in a session.
+    del jha_doc, target_table, steps_data
+    gc.collect()
\ No newline at end of file